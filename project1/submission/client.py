@@ -4,25 +4,80 @@ import socket
 import argparse
 import json
 import urllib.request
-import random
+import hashlib
+import math
+import os
+import re
 import ssl
-import ast
-import string
+
+WORDS_URL = "https://4700.network/projects/project1-words.txt"
+# the word list is downloaded once and kept next to the client
+WORDS_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "project1-words.json")
+WORD_RE = re.compile(r'^[a-z]{5}$')
+
 
 def get_words_from_server():
     """
     Get the word list from the server, ensuring proper formatting
     """
-    url = "https://4700.network/projects/project1-words.txt"
     context = ssl.create_default_context()
     context.check_hostname = False
     context.verify_mode = ssl.CERT_NONE
     
-    with urllib.request.urlopen(url, context=context) as file:
+    with urllib.request.urlopen(WORDS_URL, context=context) as file:
         words = [line.decode('utf-8').strip() for line in file.readlines()]
+    words = [word for word in words if WORD_RE.match(word)]
     print("len:", len(words))
     return words
 
+
+def words_digest(words):
+    return hashlib.sha256("\n".join(words).encode()).hexdigest()
+
+
+def load_cached_words():
+    """
+    Return the cached word list record, or None if it is missing or fails validation
+    (other URL, checksum mismatch, malformed words)
+    """
+    try:
+        with open(WORDS_CACHE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    words = cache.get("words")
+    if (cache.get("url") != WORDS_URL or not words or cache.get("sha256") != words_digest(words)
+            or not all(isinstance(word, str) and WORD_RE.match(word) for word in words)):
+        print("word list cache is invalid, downloading again")
+        return None
+    return cache
+
+
+def save_cached_words(cache):
+    tmp_path = WORDS_CACHE + ".tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, WORDS_CACHE)
+    except OSError as e:
+        print(f"could not write the word list cache: {e}") # still fine, just slower next time
+
+
+def get_words(refresh=False):
+    """
+    Word list from the disk cache, downloading (and caching) it when needed.
+    Returns (words, first_guess); the best opening guess is cached with the list
+    because scoring every word against every word is the slowest step.
+    """
+    cache = None if refresh else load_cached_words()
+    if cache is None:
+        words = get_words_from_server()
+        cache = {"url": WORDS_URL, "sha256": words_digest(words), "words": words}
+    if cache.get("first_guess") not in cache["words"]:
+        cache["first_guess"] = WordleSolver(cache["words"]).best_guess()
+        save_cached_words(cache)
+    return cache["words"], cache["first_guess"]
+
 def make_guess(game_id, word):
     guess_object = {"type": "guess",
                 "id": game_id, # start msg
@@ -42,47 +97,100 @@ def read_message(client):
     return data.strip()
 
 
-alpha = chr(ord('a') - 1)
-position = 0
-results_guess = ''
-
-def find_next_guess(previous_guess, previous_marks, word_list, tried_words=None):
+class WordleSolver:
     """
-    Systematically tries letters in each position to find the secret word.
-    Maintains correct positions (mark=2) once found.
-    
-    Args:
-        previous_guess (str): The last word that was guessed, None if first guess
-        previous_marks (list): List of marks from previous guess (0=wrong, 1=wrong position, 2=correct)
-        word_list (list): List of valid words to choose from
-        tried_words (set): Set of words already tried
-
-    Returns:
-        str: Next word to guess
+    Keeps the set of words that still fit every mark seen so far, and picks the guess
+    that splits that set the most (highest expected information).
+
+    Sets of words are Python ints used as bitsets (bit i = word_list[i]), so
+    filtering on a mark is a few ANDs over the whole list at once:
+        at[i][c]   words with letter c at position i
+        has[c]     words containing letter c anywhere
+    Marks follow the server: 2 = right letter right place, 1 = letter somewhere
+    else in the word, 0 = letter not in the word.
     """
-    global alpha
-    global position
-    global results_guess
-
-    print("previous_marks", previous_marks)
-    print("position", position)
-    print("results_guess", results_guess)
-
-    if previous_marks[position] == 2:
-        alpha = chr(ord('a') - 1)
-        results_guess += previous_guess[position]
-        position += 1
-    else:
-        alpha = chr(ord(alpha) + 1)
-
-    if len(results_guess) == 5:
-        return results_guess
-
-    for word in word_list:
-        if word[position] == alpha:
-            return word
-        
-    return word_list[0]
+
+    def __init__(self, word_list):
+        self.words = word_list
+        self.all = (1 << len(word_list)) - 1
+        self.at = [[0] * 26 for _ in range(5)]
+        self.has = [0] * 26
+        for index, word in enumerate(word_list):
+            bit = 1 << index
+            for i, letter in enumerate(word):
+                c = ord(letter) - 97
+                self.at[i][c] |= bit
+                self.has[c] |= bit
+        self.candidates = self.all
+        self.guessed = set()
+
+    def split(self, word, i, words):
+        """Split the bitset words by the mark word[i] would get: (mark 2, mark 1, mark 0)"""
+        c = ord(word[i]) - 97
+        right = words & self.at[i][c]
+        present = words & self.has[c]
+        return right, present & ~right, words & ~present
+
+    def update(self, guess, marks):
+        """Keep only the candidates that would have produced these marks for guess"""
+        self.guessed.add(guess)
+        for i, mark in enumerate(marks):
+            self.candidates = self.split(guess, i, self.candidates)[2 - mark]
+
+    def compact(self):
+        """
+        at/has tables over just the remaining candidates, so the bitsets used for
+        scoring are a few bits wide instead of one bit per word in the list
+        """
+        at = [[0] * 26 for _ in range(5)]
+        has = [0] * 26
+        bits, bit = self.candidates, 1
+        while bits:
+            low = bits & -bits
+            for i, letter in enumerate(self.words[low.bit_length() - 1]):
+                c = ord(letter) - 97
+                at[i][c] |= bit
+                has[c] |= bit
+            bits ^= low
+            bit <<= 1
+        return at, has, bit - 1
+
+    def expected_information(self, word, tables, total):
+        """Entropy in bits of the marks word would get, over the current candidates"""
+        at, has, everything = tables
+        groups = [everything]
+        for i in range(5):
+            c = ord(word[i]) - 97
+            right, present = at[i][c], has[c]
+            groups = [part for group in groups
+                      for part in (group & right, group & present & ~right, group & ~present) if part]
+        info = 0.0
+        for group in groups:
+            p = group.bit_count() / total
+            info -= p * math.log2(p)
+        return info
+
+    def best_guess(self):
+        total = self.candidates.bit_count()
+        if total <= 2:
+            return self.words[self.candidates.bit_length() - 1] # nothing to learn, just try one
+
+        tables = self.compact()
+        perfect = math.log2(total) # every candidate gets its own marks
+        best, best_score = None, -1.0
+        for index, word in enumerate(self.words):
+            if word in self.guessed:
+                continue
+            # prefer a word that could still be the answer when the information ties
+            score = self.expected_information(word, tables, total) + (1e-6 if self.candidates >> index & 1 else 0)
+            if score > best_score:
+                best, best_score = word, score
+                if score > perfect:
+                    break
+        return best
+
+    def remaining(self):
+        return self.candidates.bit_count()
 
 
 def logic_per_guess(hostname, port, username, use_tls=False):
@@ -114,15 +222,14 @@ def logic_per_guess(hostname, port, username, use_tls=False):
         print(f"message recived by the client is {response_data}")
 
         game_id = response_data["id"]
-        word_list = get_words_from_server()
-        previous_guess = word_list[0] 
-        previous_marks = [0, 0, 0, 0, 0]
+        word_list, first_guess = get_words()
+        solver = WordleSolver(word_list)
+        guess_word = first_guess
         attempts = 0
         
         # print(f"word list is {word_list}")
         while attempts < 500:
-            guess_word = find_next_guess(previous_guess, previous_marks, word_list)
-            print(f"guess_word = find_next_guess(previous_guess, previous_marks, word_list) is {guess_word}")
+            print(f"guess {attempts + 1}: {guess_word} ({solver.remaining()} words left)")
             guess_msg = make_guess(game_id, guess_word) # print guess message here!
             client.send(guess_msg.encode())
 
@@ -145,11 +252,18 @@ def logic_per_guess(hostname, port, username, use_tls=False):
                 return # terminate
             
             # increments the loop
-            previous_guess = guess_word
             guess_data = response_data["guesses"]
             # print(f"guess_data: {guess_data}")
-            previous_marks = guess_data[0]['marks']
+            previous_marks = guess_data[-1]['marks'] # the newest guess is last in the history
             print(f"previous marks: {previous_marks}")
+            solver.update(guess_word, previous_marks)
+            if not solver.remaining():
+                # the secret is not in our copy of the list, it must be out of date
+                word_list, _ = get_words(refresh=True)
+                solver = WordleSolver(word_list)
+                for guess in guess_data:
+                    solver.update(guess['word'], guess['marks'])
+            guess_word = solver.best_guess()
 
             # current msg
             # print("guess_data: ", guess_data[-1])
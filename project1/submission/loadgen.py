@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""Load generator for server.py: plays many games at once and reports games/sec and guess latency
+
+$ ./loadgen.py [--games 2000] [--concurrency 500] [--procs 1] [-s] [-p port] --words FILE [hostname]
+
+Each game connects, says hello, and guesses until it gets bye. Guesses come from
+the client's WordleSolver bitsets: the first one is a random word, then the
+highest candidate left, so the generator itself stays cheap per guess.
+"""
+import socket
+import selectors
+import argparse
+import json
+import multiprocessing
+import random
+import ssl
+import time
+
+from client import WordleSolver
+from server import load_words, raise_fd_limit
+
+
+class LoadGame:
+    __slots__ = ('sock', 'inbuf', 'game_id', 'candidates', 'guess', 'sent_at', 'guesses', 'started')
+
+    def __init__(self, sock, candidates):
+        self.sock = sock
+        self.inbuf = b""
+        self.game_id = None
+        self.candidates = candidates
+        self.guess = None
+        self.sent_at = 0.0
+        self.guesses = 0
+        self.started = time.time()
+
+
+def connect(host, port, use_tls):
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if use_tls:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        sock = context.wrap_socket(sock) # handshake while still blocking
+    sock.setblocking(False)
+    return sock
+
+
+def send(game, message):
+    game.sock.sendall((json.dumps(message) + "\n").encode()) # one short line fits the socket buffer
+
+
+def run_games(host, port, use_tls, words, games, concurrency, seed):
+    """Play games games keeping concurrency of them open, return the raw results"""
+    rng = random.Random(seed)
+    solver = WordleSolver(words)
+    selector = selectors.DefaultSelector()
+    latencies = [] # seconds from sending a guess to reading its reply
+    results = {'games': 0, 'errors': 0, 'guesses': 0, 'game_seconds': 0.0}
+    started = 0
+    active = 0
+
+    def start_game():
+        nonlocal started, active
+        started += 1
+        try:
+            game = LoadGame(connect(host, port, use_tls), solver.all)
+        except OSError as e:
+            results['errors'] += 1
+            print(f"connect failed: {e}")
+            return
+        selector.register(game.sock, selectors.EVENT_READ, game)
+        active += 1
+        send(game, {"type": "hello", "northeastern_username": "loadgen"})
+
+    def finish(game, ok):
+        nonlocal active
+        selector.unregister(game.sock)
+        game.sock.close()
+        active -= 1
+        if ok:
+            results['games'] += 1
+            results['guesses'] += game.guesses
+            results['game_seconds'] += time.time() - game.started
+        else:
+            results['errors'] += 1
+
+    def next_guess(game):
+        if game.guess is None:
+            game.guess = rng.choice(words)
+        else:
+            game.guess = words[game.candidates.bit_length() - 1]
+        game.guesses += 1
+        game.sent_at = time.time()
+        send(game, {"type": "guess", "id": game.game_id, "word": game.guess})
+
+    def handle(game, message):
+        if message["type"] == "start":
+            game.game_id = message["id"]
+            next_guess(game)
+            return True
+        latencies.append(time.time() - game.sent_at)
+        if message["type"] == "bye":
+            finish(game, True)
+            return False
+        if message["type"] != "retry":
+            print(f"server error: {message}")
+            finish(game, False)
+            return False
+        marks = message["guesses"][-1]["marks"]
+        for i, mark in enumerate(marks):
+            game.candidates = solver.split(game.guess, i, game.candidates)[2 - mark]
+        if not game.candidates:
+            print(f"no candidates left for game {game.game_id}, is --words the server's list?")
+            finish(game, False)
+            return False
+        next_guess(game)
+        return True
+
+    start_time = time.time()
+    while started < games and active < concurrency:
+        start_game()
+    while active:
+        for key, _ in selector.select(timeout=10):
+            game = key.data
+            try:
+                data = game.sock.recv(65536)
+            except (BlockingIOError, ssl.SSLWantReadError):
+                continue
+            except OSError:
+                data = b""
+            if not data:
+                finish(game, False)
+            else:
+                game.inbuf += data
+                *lines, game.inbuf = game.inbuf.split(b"\n")
+                for line in lines:
+                    if not handle(game, json.loads(line)):
+                        break
+            while started < games and active < concurrency:
+                start_game()
+    results['seconds'] = time.time() - start_time
+    results['latencies'] = latencies
+    return results
+
+
+def run_process(args):
+    return run_games(*args)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the wordle server")
+    parser.add_argument('-p', '--port', type=int, help="server port (default 27993, or 27994 with -s)")
+    parser.add_argument('-s', action='store_true', help="use TLS")
+    parser.add_argument('--words', help="the word list the server uses (.txt or .json); downloaded if not given")
+    parser.add_argument('--games', type=int, default=2000, help="games to play in total")
+    parser.add_argument('--concurrency', type=int, default=500, help="games open at the same time")
+    parser.add_argument('--procs', type=int, default=1, help="generator processes, games are split between them")
+    parser.add_argument('hostname', nargs='?', default='127.0.0.1')
+    args = parser.parse_args()
+
+    port = args.port or (27994 if args.s else 27993)
+    words = load_words(args.words)
+    raise_fd_limit()
+
+    procs = max(1, args.procs)
+    jobs = [(args.hostname, port, args.s, words, args.games // procs + (i < args.games % procs),
+             max(1, args.concurrency // procs), i) for i in range(procs)]
+    start = time.time()
+    if procs == 1:
+        parts = [run_process(jobs[0])]
+    else:
+        with multiprocessing.Pool(procs) as pool:
+            parts = pool.map(run_process, jobs)
+    elapsed = time.time() - start
+
+    games = sum(part['games'] for part in parts)
+    errors = sum(part['errors'] for part in parts)
+    guesses = sum(part['guesses'] for part in parts)
+    latencies = sorted(latency for part in parts for latency in part['latencies'])
+    print(f"{games} games ({errors} errors) in {elapsed:.2f}s, concurrency {args.concurrency}{' TLS' if args.s else ''}")
+    print(f"games/sec: {games / elapsed:.1f}   guesses/sec: {len(latencies) / elapsed:.1f}   "
+          f"guesses/game: {guesses / games if games else 0:.2f}")
+    print(f"guess latency ms: p50 {percentile(latencies, 0.5) * 1000:.2f}   p90 {percentile(latencies, 0.9) * 1000:.2f}   "
+          f"p99 {percentile(latencies, 0.99) * 1000:.2f}   max {percentile(latencies, 1.0) * 1000:.2f}")
+
+
+if __name__ == "__main__":
+    main()
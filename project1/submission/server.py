@@ -1,24 +1,46 @@
 """5700 - project 1"""
 import socket
+import selectors
+import argparse
 import json
 import random
-import string
+import resource
+import secrets
 import urllib.request
-import random
 import ssl
+import time
 
 # server side
+# one process, one selector: every connection is a non-blocking socket with its own
+# input/output buffer, so thousands of games can be in progress at the same time
+
+WORDS_URL = "https://4700.network/projects/project1-words.txt"
+MAX_GUESSES = 500
+MAX_LINE = 4096 # a longer line without a newline is not a valid message
+
+
 # instead of transferred library from each other
-def random_pick_secret_word(url):
-    context = ssl.create_default_context()
-    context.check_hostname = False
-    context.verify_mode = ssl.CERT_NONE
-    
-    file = urllib.request.urlopen(url, context=context)
-    word = file.readlines()
-    secret_word = random.choice(word).decode('utf-8').strip()  # Add decode('utf-8') because urlopen returns bytes
-    file.close()
-    return secret_word
+def load_words(path=None):
+    """
+    Load the word list once: from a text file (one word per line), from the client's
+    project1-words.json cache, or downloaded from WORDS_URL when path is None
+    """
+    if path is None:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        with urllib.request.urlopen(WORDS_URL, context=context) as file:
+            lines = [line.decode('utf-8') for line in file.readlines()]
+    elif path.endswith(".json"):
+        with open(path) as f:
+            lines = json.load(f)["words"]
+    else:
+        with open(path) as f:
+            lines = f.readlines()
+    words = [line.strip() for line in lines if len(line.strip()) == 5]
+    if not words:
+        raise ValueError("empty word list")
+    return words
 
 
 def check_the_word_position(guess_word, secret_word):
@@ -34,101 +56,268 @@ def check_the_word_position(guess_word, secret_word):
     return marks
 
 
-def server_handle_guess(guess_data, secret_word, game_id):
-    if guess_data["id"] != game_id:
-        raise ValueError("Invalid game ID")
-    
-    
-    if guess_data["word"] == secret_word: 
-        response = {
-            "type": "bye",
-            "id": game_id,
-            "flag": "" 
-        }
-        response_string = json.dumps(response) + "\n"
-        print(f"sending the second message: {response_string}")
-        return response_string
-
-    
-    marks = check_the_word_position(guess_data["word"], secret_word)
-    # keeps the history message
-    response = {
-        "type": "retry",
-        "id": game_id,
-        "guesses": [{
-            "word": guess_data["word"],
-            "marks": marks
-        }]
-    }
-
-    response_string = json.dumps(response) + "\n"
-    print(f"sending the second message: {response_string}")
-
-    return response_string
+class Game:
+    """
+    Per-game state, kept small: the secret as an index into the word list and each
+    guess as one int (word index * 243 + marks in base 3)
+    """
+    __slots__ = ('secret', 'guesses')
 
+    def __init__(self, secret):
+        self.secret = secret
+        self.guesses = []
 
-def main():
-    # create a server
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-    port = 27993 # this port could be changed to other numbers
+def encode_marks(marks):
+    code = 0
+    for mark in marks:
+        code = code * 3 + mark
+    return code
 
-    # public host name
-    server.bind((socket.gethostname(), port))
 
-    server.listen(5)
-    print(f"server is listening on port {port}")
+def decode_marks(code):
+    marks = [0] * 5
+    for i in range(4, -1, -1):
+        code, marks[i] = divmod(code, 3)
+    return marks
 
-    # server and client's connection
-    print("test for while - true")
-    try:
-        # client sends a start msg
-        # server recv
-        client, addr = server.accept()
-        print(f"connected client at {addr}")
-
-        data = client.recv(1024).decode()
-        print(f"Server: Data received from client are: {data}")
-
-        # {"type": "start", "id": <string>}\n
-        game_id = ""
-        start_msg = {"type": "start", "id": game_id}
-        message = json.dumps(start_msg) + "\n" #json format
-        client.send(message.encode())
-        print(f"Server sends the first message(S->C): {start_msg}") 
-        
-        # Pick secret word
-        url = "https://4700.network/projects/project1-words.txt"
-        secret_word = random_pick_secret_word(url)
-        print(f"Server pick a secret word is: {secret_word}")
-        
-        guess_count = 0
-        # hanlde guess
-        while guess_count < 500:
+
+class Connection:
+    """One client socket: a line-framed input buffer, pending output, and its game"""
+    __slots__ = ('sock', 'inbuf', 'outbuf', 'game_id', 'handshaking', 'closing', 'writing')
+
+    def __init__(self, sock, handshaking=False):
+        self.sock = sock
+        self.inbuf = b""
+        self.outbuf = b""
+        self.game_id = None
+        self.handshaking = handshaking
+        self.closing = False # close once outbuf has been sent
+        self.writing = False # registered for EVENT_WRITE
+
+
+class WordleServer:
+    def __init__(self, words, verbose=False):
+        self.words = words
+        self.index = {word: i for i, word in enumerate(words)}
+        self.games = {} # game id -> Game
+        self.selector = selectors.DefaultSelector()
+        self.verbose = verbose
+        self.games_finished = 0
+
+    def log(self, message):
+        if self.verbose:
+            print(message)
+
+    def listen(self, host, port, tls_context=None):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(1024)
+        server.setblocking(False)
+        self.selector.register(server, selectors.EVENT_READ, ('listen', tls_context))
+        print(f"server is listening on port {port}{' (TLS)' if tls_context else ''}")
+
+    def serve_forever(self):
+        while True:
+            for key, events in self.selector.select():
+                kind, data = key.data
+                if kind == 'listen':
+                    self.accept(key.fileobj, data)
+                else:
+                    self.handle(data, events)
+
+    def accept(self, server, tls_context):
+        # accept everything that is waiting, not just one connection per wakeup
+        while True:
             try:
-                guess_data = client.recv(1024).decode()
-                guess_data = json.loads(guess_data) # loads data
-                response_string = server_handle_guess(guess_data, secret_word, game_id)
-                client.send(response_string.encode())
-                if "bye" in response_string:
-                    break
-                guess_count += 1
-                
-            except Exception as e:
-                error_msg = {"type": "error", "message": str(e)}
-                error_msg1 = json.dumps(error_msg) + "\n"
-                client.send(error_msg1.encode())
+                sock, addr = server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"Socket error occurred: {e}") # e.g. out of file descriptors
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if tls_context:
+                sock = tls_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+            conn = Connection(sock, handshaking=tls_context is not None)
+            self.selector.register(sock, selectors.EVENT_READ, ('client', conn))
+            self.log(f"connected client at {addr}")
+
+    def handle(self, conn, events):
+        try:
+            if conn.handshaking:
+                self.handshake(conn)
+                return
+            if events & selectors.EVENT_WRITE:
+                self.flush(conn)
+            if events & selectors.EVENT_READ and conn.sock.fileno() != -1:
+                self.read(conn)
+        except (ConnectionError, ssl.SSLError, OSError) as e:
+            self.log(f"client error: {e}")
+            self.close(conn)
+        except Exception as e:
+            # a bug triggered by one client must not end every other game
+            print(f"error handling client, closing it: {e!r}")
+            self.close(conn)
+
+    def handshake(self, conn):
+        try:
+            conn.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.selector.modify(conn.sock, selectors.EVENT_READ, ('client', conn))
+            return
+        except ssl.SSLWantWriteError:
+            self.selector.modify(conn.sock, selectors.EVENT_WRITE, ('client', conn))
+            return
+        conn.handshaking = False
+        self.selector.modify(conn.sock, selectors.EVENT_READ, ('client', conn))
+        self.read(conn) # the hello may have arrived with the end of the handshake
+
+    def read(self, conn):
+        while True:
+            try:
+                data = conn.sock.recv(65536)
+            except (BlockingIOError, ssl.SSLWantReadError):
+                break
+            if not data:
+                self.close(conn)
+                return
+            conn.inbuf += data
+            # a TLS socket can hold decrypted bytes the selector does not know about
+            if not (isinstance(conn.sock, ssl.SSLSocket) and conn.sock.pending()):
+                break
+
+        # newline framing: handle every complete line, keep the partial tail
+        *lines, conn.inbuf = conn.inbuf.split(b"\n")
+        if len(conn.inbuf) > MAX_LINE:
+            self.error(conn, "message too long")
+            lines = []
+        for line in lines:
+            if conn.closing:
                 break
+            if line.strip():
+                self.handle_message(conn, line)
+        self.flush(conn)
 
-        client.close()
-    
-    except OSError as e:
-            print(f"Socket error occurred: {e}")
+    def send(self, conn, message):
+        self.log(f"sending: {message}")
+        conn.outbuf += (json.dumps(message) + "\n").encode()
 
+    def error(self, conn, text):
+        self.send(conn, {"type": "error", "message": text})
+        conn.closing = True
+
+    def handle_message(self, conn, line):
+        try:
+            message = json.loads(line)
+            kind = message["type"]
+        except (ValueError, KeyError, TypeError):
+            self.error(conn, "malformed message")
+            return
+
+        if kind == "hello" and conn.game_id is None:
+            # {"type": "start", "id": <string>}\n
+            conn.game_id = secrets.token_hex(8)
+            self.games[conn.game_id] = Game(random.randrange(len(self.words)))
+            self.send(conn, {"type": "start", "id": conn.game_id})
+        elif kind == "guess" and conn.game_id is not None:
+            self.server_handle_guess(conn, message)
+        else:
+            self.error(conn, f"unexpected message {kind}")
+
+    def server_handle_guess(self, conn, guess_data):
+        game_id = guess_data.get("id")
+        if not isinstance(game_id, str) or game_id != conn.game_id:
+            self.error(conn, "Invalid game ID")
+            return
+        word = guess_data.get("word")
+        if not isinstance(word, str) or word not in self.index:
+            self.error(conn, "Invalid word")
+            return
+
+        game = self.games[conn.game_id]
+        secret_word = self.words[game.secret]
+        if word == secret_word:
+            self.send(conn, {"type": "bye", "id": conn.game_id, "flag": secrets.token_hex(32)})
+            self.games_finished += 1
+            conn.closing = True
+            return
+
+        game.guesses.append(self.index[word] * 243 + encode_marks(check_the_word_position(word, secret_word)))
+        if len(game.guesses) >= MAX_GUESSES:
+            self.error(conn, "Too many guesses")
+            return
+
+        # keeps the history message
+        self.send(conn, {"type": "retry", "id": conn.game_id, "guesses": [
+            {"word": self.words[code // 243], "marks": decode_marks(code % 243)} for code in game.guesses]})
+
+    def flush(self, conn):
+        while conn.outbuf:
+            try:
+                sent = conn.sock.send(conn.outbuf)
+            except (BlockingIOError, ssl.SSLWantWriteError):
+                break
+            conn.outbuf = conn.outbuf[sent:]
+
+        if not conn.outbuf and conn.closing:
+            self.close(conn)
+        elif bool(conn.outbuf) != conn.writing:
+            # only wait for writability while something is stuck in the buffer
+            conn.writing = bool(conn.outbuf)
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.writing else 0)
+            self.selector.modify(conn.sock, events, ('client', conn))
+
+    def close(self, conn):
+        if conn.sock.fileno() == -1:
+            return
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+        if conn.game_id is not None:
+            self.games.pop(conn.game_id, None)
+
+
+def raise_fd_limit():
+    # each game is one socket, so allow as many as the hard limit does
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wordle game server")
+    parser.add_argument('--host', default='', help="address to bind (default: all)")
+    parser.add_argument('-p', '--port', type=int, default=27993, help="plain TCP port")
+    parser.add_argument('--tls-port', type=int, default=27994, help="TLS port, used when --cert is given")
+    parser.add_argument('--cert', help="certificate (PEM) to serve TLS with")
+    parser.add_argument('--key', help="private key (PEM), if not inside --cert")
+    parser.add_argument('--words', help="word list file (.txt, or the client's .json cache); downloaded once if not given")
+    parser.add_argument('-v', '--verbose', action='store_true', help="print every message")
+    args = parser.parse_args()
+
+    start = time.time()
+    words = load_words(args.words)
+    print(f"loaded {len(words)} words in {time.time() - start:.2f}s")
+
+    raise_fd_limit()
+    server = WordleServer(words, args.verbose)
+    server.listen(args.host, args.port)
+    if args.cert:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(args.cert, args.key)
+        server.listen(args.host, args.tls_port, context)
+
+    try:
+        server.serve_forever()
     except KeyboardInterrupt:
-        server.close()
+        print(f"{server.games_finished} games finished")
     finally:
-        server.close()
+        server.selector.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
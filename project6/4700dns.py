@@ -1,30 +1,583 @@
 #!/usr/bin/env -S python3 -u
 
-import argparse, socket, time, json, select, struct, sys, math
-from dnslib import DNSRecord, DNSHeader, RR, QTYPE, A, ZoneParser, RCODE
-from collections import defaultdict
+import argparse, socket, time, json, select, struct, sys, math, heapq, itertools, random, os, mmap, zlib
+import multiprocessing
+from dnslib import DNSRecord, DNSHeader, DNSQuestion, DNSBuffer, RR, QTYPE, A, ZoneParser, RCODE
+from collections import defaultdict, OrderedDict
 import threading
 import queue
 
+# Cache key type for NXDOMAIN entries, which cover every qtype of a name
+NXDOMAIN_KEY = "NXDOMAIN"
+
+# Trust ranks of cached data (RFC 2181 5.4.1): answer beats authority beats additional
+RANK_ADDITIONAL = 1
+RANK_AUTHORITY = 2
+RANK_ANSWER = 3
+
+MAX_CNAME_CHAIN = 8  # Longest CNAME chain we are willing to follow
+MAX_NS_DEPTH = 4  # How deep NS-name sub-resolutions may nest
+
+# Upstream timeouts follow the smoothed RTT of each server (RFC 6298 style)
+INITIAL_RTT = 0.3  # Assumed RTT of a server we have never heard from
+MIN_TIMEOUT = 0.1
+MAX_TIMEOUT = 1.0  # Per-try bound, so one bad sample cannot stretch every retry
+MAX_UPSTREAM_TRIES = 6
+UPSTREAM_BUDGET = 4.0  # Most time all tries of one upstream query may take together
+HOLD_DOWN_AFTER = 2  # Consecutive timeouts after which a server is held down
+HOLD_DOWN = 30.0  # How long a held down server is skipped
+PROBE_LINGER = 5.0  # How long a late answer to a held down server's probe still clears its hold down
+
+# Query types precompiled for every name of our zone, on top of the types it holds
+COMPILED_QTYPES = (QTYPE.A, QTYPE.AAAA, QTYPE.NS, QTYPE.CNAME, QTYPE.SOA, QTYPE.MX, QTYPE.TXT, QTYPE.PTR, QTYPE.SRV)
+MAX_COMPILED = 50000  # Bound on answers (e.g. NXDOMAIN) compiled lazily at runtime
+FLAGS_FROM_REQUEST = 0x0170  # RD, Z, AD and CD bits are copied from the request like DNSRecord.reply
+
+# Shared-memory cache slot: seq, expire time, store time, key length, value length, then key and value
+SHARED_SLOT_HEADER = struct.Struct("!IddHH")
+SHARED_SLOT_SIZE = 1024
+SHARED_PROBES = 4  # Slots probed per key (linear probing)
+
+
+class CacheEntry:
+    """One cached RRset (or negative answer) with its absolute expiry time"""
+    __slots__ = ("rrs", "expire_time", "size", "rank", "negative", "rcode")
+
+    def __init__(self, rrs, expire_time, size, rank, negative=False, rcode=RCODE.NOERROR):
+        self.rrs = rrs
+        self.expire_time = expire_time
+        self.size = size
+        self.rank = rank
+        self.negative = negative  # rrs hold the SOA of a NODATA/NXDOMAIN answer
+        self.rcode = rcode
+
+
+class RRsetCache:
+    """Cache of individual RRsets keyed by (name, rtype)
+
+    Names in keys are lowercased by put and get, since DNS names compare
+    case-insensitively. Every RRset keeps its own expiry time. Expired entries are purged through a
+    TTL min-heap, and the cache is bounded by LRU limits on entries and bytes.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=4 * 1024 * 1024):
+        self.entries = OrderedDict()  # (name, rtype) -> CacheEntry, least recently used first
+        self.expiry_heap = []  # (expire_time, seq, key), may hold stale items
+        self.seq = itertools.count()  # Tie breaker so keys never get compared in the heap
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.lock = threading.Lock()
+
+    def rrset_size(self, rrs):
+        """Approximate memory cost of an RRset by its wire size plus bookkeeping"""
+        buffer = DNSBuffer()
+        for rr in rrs:
+            rr.pack(buffer)
+        return len(buffer.data) + 128
+
+    def put(self, key, rrs, ttl, rank, negative=False, rcode=RCODE.NOERROR):
+        """Insert one entry that lives for ttl seconds, unless better data is cached"""
+        if ttl <= 0 or not rrs:
+            return
+        key = (key[0].lower(), key[1])
+        now = time.time()
+        entry = CacheEntry(list(rrs), now + ttl, self.rrset_size(rrs), rank, negative, rcode)
+
+        with self.lock:
+            current = self.entries.get(key)
+            if current and current.expire_time > now and current.rank > rank:
+                return
+            self.remove(key)
+            self.entries[key] = entry
+            self.size_bytes += entry.size
+            heapq.heappush(self.expiry_heap, (entry.expire_time, next(self.seq), key))
+            self.purge_expired(now)
+            self.evict_lru()
+
+    def remove(self, key):
+        """Drop one entry, the caller must hold the lock"""
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size_bytes -= entry.size
+
+    def purge_expired(self, now):
+        """Pop expired entries off the TTL heap, the caller must hold the lock"""
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expire_time, _, key = heapq.heappop(self.expiry_heap)
+            entry = self.entries.get(key)
+            # Heap items of replaced or evicted entries are stale, skip them
+            if entry and entry.expire_time == expire_time:
+                self.remove(key)
+
+        # Rebuild the heap once stale items dominate it
+        if len(self.expiry_heap) > 2 * len(self.entries) + 1024:
+            self.expiry_heap = [(e.expire_time, next(self.seq), k) for k, e in self.entries.items()]
+            heapq.heapify(self.expiry_heap)
+
+    def evict_lru(self):
+        """Evict least recently used entries until both limits hold"""
+        while self.entries and (len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes):
+            _, entry = self.entries.popitem(last=False)
+            self.size_bytes -= entry.size
+
+    def get(self, key):
+        """Return the live entry for key with its TTLs counted down, or None"""
+        key = (key[0].lower(), key[1])
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.expire_time <= now:
+                return None
+            self.entries.move_to_end(key)
+
+        remaining = int(entry.expire_time - now)
+        rrs = [RR(rr.rname, rr.rtype, rr.rclass, remaining, rr.rdata) for rr in entry.rrs]
+        return CacheEntry(rrs, entry.expire_time, entry.size, entry.rank, entry.negative, entry.rcode)
+
+    def store_response(self, qname, qtype, response):
+        """Split a bailiwick checked upstream response into RRsets and cache them"""
+        sections = ((response.rr, RANK_ANSWER), (response.auth, RANK_AUTHORITY), (response.ar, RANK_ADDITIONAL))
+        for records, rank in sections:
+            rrsets = OrderedDict()
+            for rr in records:
+                if rr.rtype == QTYPE.OPT:
+                    continue
+                rrsets.setdefault((str(rr.rname).rstrip("."), rr.rtype), []).append(rr)
+            for key, rrs in rrsets.items():
+                self.put(key, rrs, min(rr.ttl for rr in rrs), rank)
+
+        # RFC 2308: negative answers live for min(SOA TTL, SOA minimum)
+        soa = [rr for rr in response.auth if rr.rtype == QTYPE.SOA]
+        if not soa:
+            return
+        negative_ttl = min(soa[0].ttl, soa[0].rdata.times[4])
+
+        # The negative answer belongs to the end of any CNAME chain in the answer
+        name = qname.lower()
+        for rr in response.rr:
+            if rr.rtype == QTYPE.CNAME and str(rr.rname).rstrip(".").lower() == name:
+                name = str(rr.rdata.label).rstrip(".").lower()
+
+        if response.header.rcode == RCODE.NXDOMAIN:
+            self.put((name, NXDOMAIN_KEY), soa[:1], negative_ttl, RANK_ANSWER, True, RCODE.NXDOMAIN)
+        elif response.header.rcode == RCODE.NOERROR and not any(rr.rtype == qtype for rr in response.rr):
+            self.put((name, qtype), soa[:1], negative_ttl, RANK_ANSWER, True)
+
+    def lookup_response(self, request):
+        """Build a reply to request purely from cached RRsets, or return None on a miss"""
+        qtype = request.q.qtype
+        name = str(request.q.qname).rstrip(".")
+        response = request.reply()
+        response.header.ra = True
+
+        for _ in range(MAX_CNAME_CHAIN):
+            nxdomain = self.get((name, NXDOMAIN_KEY))
+            if nxdomain:
+                response.header.rcode = RCODE.NXDOMAIN
+                for rr in nxdomain.rrs:
+                    response.add_auth(rr)
+                return response
+
+            entry = self.get((name, qtype))
+            if entry and entry.rank >= RANK_AUTHORITY:
+                if entry.negative:
+                    for rr in entry.rrs:
+                        response.add_auth(rr)
+                    return response
+                for rr in entry.rrs:
+                    response.add_answer(rr)
+                self.add_cached_glue(response, entry.rrs)
+                return response
+
+            if qtype == QTYPE.CNAME:
+                return None
+            cname = self.get((name, QTYPE.CNAME))
+            if not cname or cname.negative:
+                return None
+            for rr in cname.rrs:
+                response.add_answer(rr)
+            name = str(cname.rrs[0].rdata.label).rstrip(".")
+
+        return None
+
+    def add_cached_glue(self, response, rrs):
+        """Add cached addresses of NS/MX targets to the additional section"""
+        for rr in rrs:
+            if rr.rtype not in (QTYPE.NS, QTYPE.MX):
+                continue
+            glue = self.get((str(rr.rdata.label).rstrip("."), QTYPE.A))
+            if glue and not glue.negative:
+                for glue_rr in glue.rrs:
+                    response.add_ar(glue_rr)
+
+    def closest_zone_cut(self, qname):
+        """Find the deepest cached delegation for qname with usable NS addresses"""
+        labels = qname.split(".") if qname else []
+        for i in range(len(labels)):
+            zone = ".".join(labels[i:])
+            ns = self.get((zone, QTYPE.NS))
+            if not ns or ns.negative:
+                continue
+
+            server_ips = []
+            for ns_rr in ns.rrs:
+                addrs = self.get((str(ns_rr.rdata.label).rstrip("."), QTYPE.A))
+                if addrs and not addrs.negative:
+                    server_ips += [str(rr.rdata) for rr in addrs.rrs]
+            if server_ips:
+                return zone, server_ips
+        return None
+
+
+class UpstreamWaiter:
+    """A resolver thread waiting for the first matching answer to its query"""
+    __slots__ = ("qname", "qtype", "event", "response")
+
+    def __init__(self, request):
+        self.qname = str(request.q.qname).lower()
+        self.qtype = request.q.qtype
+        self.event = threading.Event()
+        self.response = None
+
+
+class UpstreamTransport:
+    """Shared non-blocking upstream sockets with transaction-ID demultiplexing
+
+    Every resolver thread sends through a small pool of long-lived UDP sockets
+    bound to random ports, and one receiver thread hands each response to the
+    waiting query by (socket, transaction ID, server). Smoothed per-server RTTs
+    pick the fastest nameserver and set the retransmission timeout.
+    """
+
+    def __init__(self, port, pool_size, race, log):
+        self.port = port
+        self.race = race  # Also query the second fastest server on the first try
+        self.log = log
+        self.random = random.SystemRandom()
+        self.sockets = []
+        for _ in range(max(1, pool_size)):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("0.0.0.0", 0))
+            sock.setblocking(False)
+            self.sockets.append(sock)
+
+        self.outstanding = {}  # (socket fileno, txid) -> (waiter, server ip, send time)
+        self.rtt = {}  # server ip -> (srtt, rttvar)
+        self.timeouts = {}  # server ip -> consecutive timeouts
+        self.down_until = {}  # server ip -> time its hold down ends
+        self.lingering = []  # (drop time, demux key) of probes still listening for a late answer
+        self.lock = threading.Lock()
+        threading.Thread(target=self.receive_loop, daemon=True).start()
+
+    def rank(self, server_ips):
+        """Order nameservers fastest first, unknown servers get INITIAL_RTT"""
+        unique = list(OrderedDict.fromkeys(server_ips))
+        with self.lock:
+            return sorted(unique, key=lambda ip: self.rtt.get(ip, (INITIAL_RTT, 0))[0])
+
+    def timeout(self, server_ip):
+        """Retransmission timeout for one server, srtt + 4 * rttvar"""
+        with self.lock:
+            srtt, rttvar = self.rtt.get(server_ip, (INITIAL_RTT, INITIAL_RTT / 2))
+        return min(MAX_TIMEOUT, max(MIN_TIMEOUT, srtt + 4 * rttvar))
+
+    def update_rtt(self, server_ip, sample):
+        """Fold an RTT sample into the smoothed estimate, the caller must hold the lock"""
+        if server_ip not in self.rtt:
+            self.rtt[server_ip] = (sample, sample / 2)
+            return
+        srtt, rttvar = self.rtt[server_ip]
+        rttvar = 0.75 * rttvar + 0.25 * abs(srtt - sample)
+        srtt = 0.875 * srtt + 0.125 * sample
+        self.rtt[server_ip] = (srtt, rttvar)
+
+    def penalize(self, server_ip):
+        """Back off a server that timed out so healthier ones are preferred, and
+        hold it down for a while once it keeps timing out"""
+        with self.lock:
+            srtt, rttvar = self.rtt.get(server_ip, (INITIAL_RTT, INITIAL_RTT / 2))
+            self.rtt[server_ip] = (min(srtt * 2, MAX_TIMEOUT), rttvar)
+            self.timeouts[server_ip] = self.timeouts.get(server_ip, 0) + 1
+            if self.timeouts[server_ip] >= HOLD_DOWN_AFTER:
+                self.down_until[server_ip] = time.time() + HOLD_DOWN
+
+    def held_down(self, server_ips):
+        """The subset of server_ips that recently kept timing out"""
+        now = time.time()
+        with self.lock:
+            return {ip for ip in server_ips if self.down_until.get(ip, 0) > now}
+
+    def send(self, waiter, server_ip, request):
+        """Send request to server_ip under a fresh random ID, return its demux key"""
+        sock = self.random.choice(self.sockets)
+        data = bytearray(request.pack())
+        with self.lock:
+            txid = self.random.randrange(65536)
+            while (sock.fileno(), txid) in self.outstanding:
+                txid = self.random.randrange(65536)
+            key = (sock.fileno(), txid)
+            self.outstanding[key] = (waiter, server_ip, time.time())
+        data[0:2] = struct.pack("!H", txid)
+
+        try:
+            sock.sendto(bytes(data), (server_ip, self.port))
+        except OSError as e:
+            self.log(f"Error sending query to {server_ip}:{self.port}: {e}")
+        return key
+
+    def query(self, server_ips, request):
+        """Query the fastest of server_ips, failing over on timeouts
+
+        All tries together take at most UPSTREAM_BUDGET. Held down servers are
+        skipped; if every server is held down a single probe is sent to the fastest
+        one, with its usual timeout. A probe that times out does not extend the
+        hold down, and its demux entry lingers so a late answer still clears it.
+        Returns the response (or None) and the number of packets sent.
+        """
+        waiter = UpstreamWaiter(request)
+        servers = self.rank(server_ips)
+        down = self.held_down(servers)
+        tries, probe = MAX_UPSTREAM_TRIES, False
+        if len(down) == len(servers):
+            self.log(f"All of {', '.join(servers)} are held down, sending one probe")
+            servers, tries, probe = servers[:1], 1, True
+        else:
+            servers = [ip for ip in servers if ip not in down]
+
+        deadline = time.time() + UPSTREAM_BUDGET
+        keys = []
+        try:
+            for attempt in range(tries):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                targets = [servers[attempt % len(servers)]]
+                if self.race and attempt == 0 and len(servers) > 1:
+                    targets.append(servers[1])
+
+                for server_ip in targets:
+                    self.log(f"Sending query to {server_ip}:{self.port} (attempt {attempt+1})")
+                    keys.append(self.send(waiter, server_ip, request))
+
+                # Answers to earlier attempts still count while we wait
+                if waiter.event.wait(min(max(self.timeout(ip) for ip in targets), remaining)):
+                    return waiter.response, len(keys)
+
+                for server_ip in targets:
+                    self.log(f"Query to {server_ip}:{self.port} timed out (attempt {attempt+1})")
+                    if not probe:
+                        self.penalize(server_ip)
+        finally:
+            with self.lock:
+                for key in keys:
+                    if probe and not waiter.event.is_set():
+                        self.lingering.append((time.time() + PROBE_LINGER, key))
+                    else:
+                        self.outstanding.pop(key, None)
+        return None, len(keys)
+
+    def drop_lingering(self):
+        """Forget probes whose late answers are no longer awaited"""
+        now = time.time()
+        with self.lock:
+            while self.lingering and self.lingering[0][0] <= now:
+                self.outstanding.pop(self.lingering.pop(0)[1], None)
+
+    def receive_loop(self):
+        """Hand every upstream response to the query that is waiting for it"""
+        while True:
+            readable = select.select(self.sockets, [], [], 1.0)[0]
+            self.drop_lingering()
+            for sock in readable:
+                try:
+                    data, addr = sock.recvfrom(65535)
+                except OSError:
+                    continue
+                if len(data) < 12:
+                    continue
+
+                txid = struct.unpack("!H", data[:2])[0]
+                with self.lock:
+                    sent = self.outstanding.get((sock.fileno(), txid))
+                if not sent or addr[0] != sent[1]:
+                    # Late, unknown or spoofed answer
+                    continue
+
+                try:
+                    response = DNSRecord.parse(data)
+                except Exception:
+                    continue
+                waiter, server_ip, send_time = sent
+                if str(response.q.qname).lower() != waiter.qname or response.q.qtype != waiter.qtype:
+                    continue
+
+                with self.lock:
+                    self.update_rtt(server_ip, time.time() - send_time)
+                    self.timeouts.pop(server_ip, None)
+                    self.down_until.pop(server_ip, None)
+                    if waiter.event.is_set():
+                        continue
+                    waiter.response = response
+                waiter.event.set()
+
+
+class SharedCache:
+    """Fixed-size hash table of resolved responses in anonymous shared memory
+
+    It is created before the workers fork, so every worker maps the same pages
+    and a resolution made by one worker is a hit for the others. A slot is only
+    written under the striped lock of that slot, so put takes the stripes of its
+    whole probe window (in order, so writers never deadlock); readers take no lock and use each slot's sequence
+    number (odd while a write is in progress) to detect torn reads.
+    """
+
+    def __init__(self, size_bytes=16 * 1024 * 1024, stripes=64):
+        self.slots = max(SHARED_PROBES, size_bytes // SHARED_SLOT_SIZE)
+        self.memory = mmap.mmap(-1, self.slots * SHARED_SLOT_SIZE)  # MAP_SHARED, survives fork
+        self.locks = [multiprocessing.Lock() for _ in range(stripes)]
+
+    def key_bytes(self, qname, qtype):
+        return ("%s/%d" % (qname.lower(), qtype)).encode()
+
+    def probe(self, key):
+        """Slot offsets a key may live in"""
+        start = zlib.crc32(key) % self.slots
+        return [((start + i) % self.slots) * SHARED_SLOT_SIZE for i in range(SHARED_PROBES)]
+
+    def read_slot(self, offset):
+        """Consistent copy of one slot as (expire, stored, key, value), or None while it is written"""
+        for _ in range(3):
+            seq, expire_time, stored_time, key_len, value_len = SHARED_SLOT_HEADER.unpack_from(self.memory, offset)
+            if seq & 1 or SHARED_SLOT_HEADER.size + key_len + value_len > SHARED_SLOT_SIZE:
+                continue
+            body_start = offset + SHARED_SLOT_HEADER.size
+            key = self.memory[body_start:body_start + key_len]
+            value = self.memory[body_start + key_len:body_start + key_len + value_len]
+            if struct.unpack_from("!I", self.memory, offset)[0] == seq:
+                return expire_time, stored_time, key, value
+        return None
+
+    def get(self, qname, qtype):
+        """Return the shared response for (qname, qtype) with TTLs counted down, or None"""
+        key = self.key_bytes(qname, qtype)
+        now = time.time()
+        for offset in self.probe(key):
+            slot = self.read_slot(offset)
+            if not slot or slot[2] != key:
+                continue
+            expire_time, stored_time, _, value = slot
+            if expire_time <= now:
+                return None
+            try:
+                response = DNSRecord.parse(value)
+            except Exception:
+                return None  # Damaged slot, treat it as a miss
+
+            elapsed = int(now - stored_time)
+            for rr in response.rr + response.auth + response.ar:
+                rr.ttl = max(0, rr.ttl - elapsed)
+            return response
+        return None
+
+    def stripes(self, offsets):
+        """Locks covering the given slots, in a fixed order"""
+        indexes = sorted({offset // SHARED_SLOT_SIZE % len(self.locks) for offset in offsets})
+        return [self.locks[i] for i in indexes]
+
+    def put(self, qname, qtype, response):
+        """Publish a resolved response until its shortest TTL runs out"""
+        records = response.rr + response.auth + response.ar
+        ttls = [rr.ttl for rr in records if rr.rtype != QTYPE.OPT]
+        ttls += [rr.rdata.times[4] for rr in response.auth if rr.rtype == QTYPE.SOA]
+        key = self.key_bytes(qname, qtype)
+        value = bytes(response.pack())
+        if not ttls or min(ttls) <= 0 or SHARED_SLOT_HEADER.size + len(key) + len(value) > SHARED_SLOT_SIZE:
+            return
+
+        now = time.time()
+        offsets = self.probe(key)
+        # The slot written can be any of the probed ones, so hold the lock of each
+        locks = self.stripes(offsets)
+        for lock in locks:
+            lock.acquire()
+        try:
+            # Reuse the key's slot or a free one, otherwise evict the soonest to expire
+            victim, victim_expire = offsets[0], None
+            for offset in offsets:
+                _, expire_time, _, key_len, _ = SHARED_SLOT_HEADER.unpack_from(self.memory, offset)
+                body_start = offset + SHARED_SLOT_HEADER.size
+                if expire_time <= now or self.memory[body_start:body_start + key_len] == key:
+                    victim = offset
+                    break
+                if victim_expire is None or expire_time < victim_expire:
+                    victim, victim_expire = offset, expire_time
+
+            seq = struct.unpack_from("!I", self.memory, victim)[0]
+            struct.pack_into("!I", self.memory, victim, (seq + 1) & 0xFFFFFFFF | 1)
+            body_start = victim + SHARED_SLOT_HEADER.size
+            self.memory[body_start:body_start + len(key) + len(value)] = key + value
+            SHARED_SLOT_HEADER.pack_into(self.memory, victim, (seq + 2) & 0xFFFFFFFE,
+                                         now + min(ttls), now, len(key), len(value))
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+
+class PendingQuery:
+    """An in-flight resolution of one (qname, qtype) that later askers wait on"""
+    __slots__ = ("done", "data", "upstream_queries", "waiters", "leader")
+
+    def __init__(self):
+        self.leader = threading.get_ident()
+        self.done = threading.Event()
+        self.data = None  # Packed response, so every waiter parses its own copy
+        self.upstream_queries = 0  # Upstream queries the first resolution cost
+        self.waiters = 0
+
+
 class Server:
-    def __init__(self, root_ip, zone_path, port):
+    def __init__(self, root_ip, zone_path, port, cache_entries=10000, cache_bytes=4 * 1024 * 1024,
+                 upstream_port=60053, upstream_sockets=4, race=False, precompile=True,
+                 sock=None, shared_cache=None, parent_pid=None):
         self.root_ip = root_ip
         self.zone_path = zone_path
         self.ns_records = []
         self.root_server_ip = root_ip
-        self.cache = {}
-        self.cache_lock = threading.Lock()  # Lock for thread-safe cache access
-        self.pending_queries = {}  # Track pending queries for timeouts
+        self.cache = RRsetCache(cache_entries, cache_bytes)
+        self.pending_queries = {}  # (qname, qtype) -> PendingQuery for in-flight resolutions
         self.pending_lock = threading.Lock()  # Lock for thread-safe pending queries
+        self.waiting_on = {}  # thread ident -> PendingQuery it waits for, to spot waits in a circle
+        self.local = threading.local()  # Per-thread upstream counter and led resolutions
+        self.stats = defaultdict(int)  # Coalescing metrics
+        self.stats_lock = threading.Lock()
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind(("127.0.0.1", port))  # Bind to localhost
+        self.shared_cache = shared_cache  # Cache shared with the other workers, if any
+        self.parent_pid = parent_pid  # Workers exit when the process that forked them is gone
+
+        self.socket = sock or Server.bind_socket(port)
         self.port = self.socket.getsockname()[1]
         self.log("Bound to port %d" % self.port)
+        self.transport = UpstreamTransport(upstream_port, upstream_sockets, race, self.log)
 
         self.record_map = defaultdict(list)  # used to extract the qname
         self.soa_domain = self.parse_zone_file(zone_path)  # parse the zone_file
 
+        # (wire qname in lower case, qtype) -> packed authoritative response
+        self.compiled = {}
+        self.precompile = precompile
+        if precompile:
+            self.compile_zone()
+
+    @staticmethod
+    def bind_socket(port, reuse_port=False):
+        """Bind the client-facing UDP socket, shareable between workers with SO_REUSEPORT"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("127.0.0.1", port))  # Bind to localhost
+        return sock
+
     def log(self, message):
         sys.stderr.write(message + "\n")
         sys.stderr.flush() 
@@ -35,6 +588,11 @@ class Server:
 
     def recv(self, socket):
         data, addr = socket.recvfrom(65535)
+        
+        # Hot path: answers for our own zone are pre-packed
+        if self.precompile and self.answer_compiled(data, addr):
+            return f"Served compiled answer to {addr}"
+        
         request = DNSRecord.parse(data)
         self.log("Received message from %s:\n%s" % (addr, request))
         
@@ -75,23 +633,19 @@ class Server:
         if is_auth:
             # We're authoritative, serve from our records
             response = self.serve_authoritative(request, qname, qtype)
+            
+            # Remember answers the load-time compile could not know about (NXDOMAIN names)
+            if self.precompile and len(self.compiled) < MAX_COMPILED and \
+                    (self.wire_name(qname), qtype) not in self.compiled:
+                self.compile_answer(qname, qtype)
         else:
             # First check cache
-            with self.cache_lock:
-                cached_response = self.cache_lookup(qname, qtype)
+            cached_response = self.cache.lookup_response(request)
             
             if cached_response:
-                # Use cached response
-                response = request.reply()
-                for rr in cached_response.rr:
-                    response.add_answer(rr)
-                for rr in cached_response.auth:
-                    response.add_auth(rr)
-                for rr in cached_response.ar:
-                    response.add_ar(rr)
-                
-                # Set recursion flags
-                response.header.ra = True
+                # Use cached response, TTLs already counted down
+                self.log("Cache hit for %s" % qname)
+                response = cached_response
             else:
                 # Need to do recursive lookup
                 response = self.recursive_query(request)
@@ -100,10 +654,76 @@ class Server:
     
     def is_authoritative_for(self, qname):
         """Check if we are authoritative for the given domain"""
+        qname = qname.lower()
         return qname == self.soa_domain or qname.endswith("." + self.soa_domain)
     
+    def wire_name(self, name):
+        """Encode a domain name as lower case wire-format labels"""
+        labels = [label for label in name.lower().encode().split(b".") if label]
+        return b"".join(bytes([len(label)]) + label for label in labels) + b"\0"
+
+    def compile_zone(self):
+        """Pre-pack the answer to every (name, qtype) of our zone, the zone never changes"""
+        qtypes = set(COMPILED_QTYPES)
+        for rrs in self.record_map.values():
+            qtypes.update(rr.rtype for rr in rrs)
+        
+        for name in list(self.record_map):
+            if self.is_authoritative_for(name):
+                for qtype in qtypes:
+                    self.compile_answer(name, qtype)
+        self.log(f"Compiled {len(self.compiled)} authoritative answers")
+
+    def compile_answer(self, qname, qtype):
+        """Build the authoritative response for (qname, qtype) once and keep its wire format
+
+        The index is keyed by the lowercased name, so the answer is built from that same name.
+        """
+        qname = qname.lower()
+        request = DNSRecord(DNSHeader(id=0, rd=0), q=DNSQuestion(qname, qtype))
+        response = self.serve_authoritative(request, qname, qtype)
+        self.compiled[(self.wire_name(qname), qtype)] = bytes(response.pack())
+
+    def answer_compiled(self, data, addr):
+        """Serve a plain query for our zone straight from the compiled index
+
+        Only the header and question are parsed; the response is the compiled one
+        with the transaction ID, the request flags and the question patched in.
+        Returns False when the query has to take the normal path.
+        """
+        if len(data) < 17:
+            return False
+        txid, flags, qdcount = struct.unpack("!HHH", data[:6])
+        if flags & 0xF800 or qdcount != 1:
+            # A response, an opcode other than QUERY, or several questions
+            return False
+        
+        # Walk the question labels, compression is never used in a question
+        end = 12
+        while data[end] != 0:
+            if data[end] & 0xC0:
+                return False
+            end += data[end] + 1
+            if end >= len(data):
+                return False
+        end += 1
+        if end + 4 > len(data):
+            return False
+        
+        qtype, qclass = struct.unpack("!HH", data[end:end + 4])
+        template = self.compiled.get((bytes(data[12:end]).lower(), qtype))
+        if template is None or qclass != 1:
+            return False
+        
+        question_end = end + 4
+        template_flags = struct.unpack("!H", template[2:4])[0]
+        header = struct.pack("!HH", txid, template_flags | (flags & FLAGS_FROM_REQUEST)) + template[4:12]
+        self.socket.sendto(header + data[12:question_end] + template[question_end:], addr)
+        return True
+
     def serve_authoritative(self, request, qname, qtype):
         """Serve records from our authoritative zone"""
+        qname = qname.lower()
         response = request.reply()
         found = False
         
@@ -123,7 +743,7 @@ class Server:
                 if rr.rtype == QTYPE.CNAME:
                     response.add_answer(rr)
                     found = True
-                    cname_target = str(rr.rdata.label).rstrip(".")
+                    cname_target = str(rr.rdata.label).rstrip(".").lower()
                     
                     # Recursively resolve the CNAME target if it's in our zone
                     if cname_target in self.record_map:
@@ -144,7 +764,7 @@ class Server:
                     found = True
                     
                     # Add glue A records in ADDITIONAL section
-                    ns_host = str(rr.rdata.label).rstrip(".")
+                    ns_host = str(rr.rdata.label).rstrip(".").lower()
                     if ns_host in self.record_map:
                         for glue_rr in self.record_map[ns_host]:
                             if glue_rr.rtype == QTYPE.A:
@@ -167,9 +787,11 @@ class Server:
         response = request.reply()
         
         # Perform the recursive lookup
-        final_response = self.perform_recursive_lookup(request)
+        final_response = self.coalesced_lookup(request, "client")
         
         if final_response:
+            final_response = self.follow_cname_chain(request, final_response)
+
             # Copy the results to our response
             response.header = final_response.header
             response.rr = final_response.rr
@@ -186,39 +808,142 @@ class Server:
         
         return response
     
-    def perform_recursive_lookup(self, request):
+    def follow_cname_chain(self, request, response):
+        """Resolve CNAME targets the authority left out of its answer"""
+        qtype = request.q.qtype
+        if qtype == QTYPE.CNAME:
+            return response
+
+        for _ in range(MAX_CNAME_CHAIN):
+            if response.header.rcode != RCODE.NOERROR or any(rr.rtype == qtype for rr in response.rr):
+                break
+            cnames = [rr for rr in response.rr if rr.rtype == QTYPE.CNAME]
+            if not cnames:
+                break
+
+            target = str(cnames[-1].rdata.label).rstrip(".")
+            target_request = DNSRecord.question(target, QTYPE[qtype])
+            target_response = self.cache.lookup_response(target_request) or self.coalesced_lookup(target_request, "cname")
+            if not target_response:
+                break
+
+            # Append the target's answers, keeping the first CNAME ahead of them
+            for rr in target_response.rr:
+                response.add_answer(rr)
+            response.header.rcode = target_response.header.rcode
+            response.auth = target_response.auth
+
+        return response
+
+    def coalesced_lookup(self, request, kind, depth=0):
+        """Run one perform_recursive_lookup per in-flight (qname, qtype) and share its answer"""
+        key = (str(request.q.qname).rstrip(".").lower(), request.q.qtype)
+        if not hasattr(self.local, "led"):
+            self.local.led = set()
+        led = self.local.led
+        if key in led:
+            # This thread is already resolving key further up the stack, a loop
+            return None
+
+        me = threading.get_ident()
+        with self.pending_lock:
+            pending = self.pending_queries.get(key)
+            leader = pending is None
+            if leader:
+                pending = PendingQuery()
+                self.pending_queries[key] = pending
+            else:
+                # Waiting would close a circle if the leader (transitively) waits on us
+                owner = pending.leader
+                while owner != me and owner in self.waiting_on:
+                    owner = self.waiting_on[owner].leader
+                if owner == me:
+                    return None
+                pending.waiters += 1
+                self.waiting_on[me] = pending
+
+        if not leader:
+            # Wait for the first asker instead of repeating its upstream queries, and
+            # share its failure too: re-resolving would only repeat the same timeouts
+            pending.done.wait()
+            with self.pending_lock:
+                del self.waiting_on[me]
+            self.record_coalesced(kind, key, pending.upstream_queries)
+            return DNSRecord.parse(pending.data) if pending.data else None
+
+        led.add(key)
+        start = self.upstream_count()
+        response = None
+        try:
+            # The answer may have been cached while we checked pending_queries
+            response = self.cache.lookup_response(request) or self.shared_lookup(request) or \
+                self.perform_recursive_lookup(request, depth)
+            if response:
+                pending.data = response.pack()
+                if self.shared_cache:
+                    self.shared_cache.put(key[0], key[1], response)
+        finally:
+            pending.upstream_queries = self.upstream_count() - start
+            led.discard(key)
+            with self.pending_lock:
+                del self.pending_queries[key]
+            pending.done.set()
+        return response
+
+    def shared_lookup(self, request):
+        """Look for an answer another worker already resolved"""
+        if not self.shared_cache:
+            return None
+        qname = str(request.q.qname).rstrip(".")
+        response = self.shared_cache.get(qname, request.q.qtype)
+        if response:
+            self.log(f"Shared cache hit for {qname}")
+            response.header.id = request.header.id
+            self.cache.store_response(qname, request.q.qtype, response)
+        return response
+
+    def upstream_count(self):
+        """Upstream queries this thread has sent so far"""
+        return getattr(self.local, "upstream_queries", 0)
+
+    def record_coalesced(self, kind, key, upstream_queries):
+        """Update and log the coalescing metrics for one deduplicated lookup"""
+        with self.stats_lock:
+            self.stats["coalesced_" + kind] += 1
+            self.stats["upstream_saved"] += upstream_queries
+            total = self.stats["upstream_saved"]
+        self.log(f"Coalesced {kind} lookup for {key[0]} ({upstream_queries} upstream queries saved, {total} total)")
+
+    def perform_recursive_lookup(self, request, depth=0):
         """Actual recursive lookup implementation with retries"""
         qname = str(request.q.qname).rstrip(".")
         qtype = request.q.qtype
         
-        # Start from the root server
-        server_ip = self.root_server_ip
-        server_port = 60053  # Root server port
+        # Start from the closest zone cut we already know, otherwise from the root
+        zone, server_ips = self.cache.closest_zone_cut(qname) or ("", [self.root_server_ip])
+        if zone:
+            self.log(f"Starting lookup for {qname} at cached zone cut {zone}")
         
         # We may need to make multiple queries
         remaining_steps = 20  # Limit the number of steps to avoid infinite loops
-        
-        # Track the current domain we're querying
-        current_domain = qname
+        response = None
         
         while remaining_steps > 0:
             remaining_steps -= 1
             
-            # Send the query to the current server
-            response = self.send_query_with_retries(server_ip, server_port, request)
+            # Send the query to the fastest of the current servers
+            response = self.send_query_with_retries(server_ips, request)
             
             if not response:
                 # Server didn't respond after retries
                 return None
             
-            # Apply bailiwick checking
-            response = self.bailiwick_check(current_domain, response)
+            # Only trust records inside the zone the server is authoritative for
+            response = self.bailiwick_check(zone, response)
+            self.cache.store_response(qname, qtype, response)
             
-            # Check if we got an answer
-            if len(response.rr) > 0:
-                # Cache the successful response
-                with self.cache_lock:
-                    self.cache_store(qname, qtype, response)
+            # Check if we got an answer (or a definitive error)
+            if len(response.rr) > 0 or response.header.rcode != RCODE.NOERROR:
                 return response
             
             # No answer yet, check for delegation
@@ -228,96 +953,53 @@ class Server:
                 # No delegation, return what we have
                 return response
             
-            # We have a delegation, get the next server
-            next_server_found = False
+            # Only follow referrals that move closer to the query name
+            next_zone = str(ns_records[0].rname).rstrip(".")
+            if next_zone == zone or not self.in_bailiwick(zone, next_zone):
+                return response
             
-            # Try to find a glue record first
-            for ns_record in ns_records:
-                ns_name = str(ns_record.rdata.label).rstrip(".")
-                
-                # Look for a matching A record in the additional section
-                for ar in response.ar:
-                    if ar.rtype == QTYPE.A and str(ar.rname).rstrip(".") == ns_name:
-                        server_ip = str(ar.rdata)
-                        current_domain = ns_name
-                        next_server_found = True
-                        break
-                
-                if next_server_found:
-                    break
+            # Try to find glue records first
+            ns_names = [str(rr.rdata.label).rstrip(".") for rr in ns_records]
+            next_ips = [str(ar.rdata) for ar in response.ar
+                        if ar.rtype == QTYPE.A and str(ar.rname).rstrip(".") in ns_names]
             
             # If no glue record, we need to resolve the NS name
-            if not next_server_found and ns_records:
-                ns_name = str(ns_records[0].rdata.label).rstrip(".")
-                current_domain = ns_name
+            if not next_ips and depth < MAX_NS_DEPTH:
+                ns_request = DNSRecord.question(ns_names[0], "A")
+                ns_response = self.cache.lookup_response(ns_request) or \
+                    self.coalesced_lookup(ns_request, "ns", depth + 1)
                 
-                # Create a new request for the NS name
-                ns_request = DNSRecord.question(ns_name, "A")
-                ns_request.header.rd = 1  # Set recursion desired
-                
-                # Recursively resolve the NS name
-                ns_response = self.perform_recursive_lookup(ns_request)
-                
-                if ns_response and ns_response.rr:
-                    for rr in ns_response.rr:
-                        if rr.rtype == QTYPE.A:
-                            server_ip = str(rr.rdata)
-                            next_server_found = True
-                            break
+                if ns_response:
+                    next_ips = [str(rr.rdata) for rr in ns_response.rr if rr.rtype == QTYPE.A]
             
-            if not next_server_found:
+            if not next_ips:
                 # Could not find next server
                 return response
             
             # Continue with the next server
-            server_port = 60053  # Use 60053 for all DNS servers in this project
+            zone, server_ips = next_zone, next_ips
         
         # Exceeded maximum steps
         return response
     
-    def send_query_with_retries(self, server_ip, server_port, request):
-        """Send a DNS query with retries on timeout"""
-        retry_count = 0
-        max_retries = 5
-        timeout = 1.0  # 1 second timeout
-        
-        while retry_count <= max_retries:
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock.settimeout(timeout)
-                
-                self.log(f"Sending query to {server_ip}:{server_port} (attempt {retry_count+1})")
-                sock.sendto(request.pack(), (server_ip, server_port))
-                
-                data, _ = sock.recvfrom(65535)
-                sock.close()
-                
-                # Successfully received response
-                return DNSRecord.parse(data)
-                
-            except socket.timeout:
-                # Timed out, retry
-                self.log(f"Query to {server_ip}:{server_port} timed out (attempt {retry_count+1})")
-                retry_count += 1
-                sock.close()
-            
-            except Exception as e:
-                # Other error
-                self.log(f"Error sending query to {server_ip}:{server_port}: {e}")
-                sock.close()
-                return None
+    def send_query_with_retries(self, server_ips, request):
+        """Send a DNS query through the shared transport, retrying and failing over on timeout"""
+        response, sent = self.transport.query(server_ips, request)
+        self.local.upstream_queries = self.upstream_count() + sent
         
-        # All retries failed
-        self.log(f"All retries to {server_ip}:{server_port} failed")
-        return None
+        if not response:
+            # All retries failed
+            self.log(f"All retries to {', '.join(server_ips)} failed")
+        return response
     
     def in_bailiwick(self, domain, rr_name):
         """Check if a record is within bailiwick of a domain"""
         rr_name = str(rr_name).rstrip(".")
         domain = str(domain).rstrip(".")
         
-        # Record is within bailiwick if it's the domain itself or a subdomain
-        return rr_name == domain or rr_name.endswith("." + domain)
+        # Record is within bailiwick if it's the domain itself or a subdomain,
+        # the root zone vouches for everything
+        return not domain or rr_name == domain or rr_name.endswith("." + domain)
     
     def bailiwick_check(self, domain, response):
         """Filter out records that are outside of bailiwick"""
@@ -334,76 +1016,6 @@ class Server:
         
         return filtered_response
     
-    def cache_store(self, qname, qtype, response):
-        """Store a response in the cache with proper TTL handling"""
-        if response.header.rcode != RCODE.NOERROR or (len(response.rr) == 0 and len(response.auth) == 0):
-            # Don't cache error responses or empty responses
-            return
-        
-        # Find the minimum TTL from all records
-        all_records = response.rr + response.auth + response.ar
-        if not all_records:
-            return
-        
-        min_ttl = min(rr.ttl for rr in all_records if rr.ttl > 0)
-        if min_ttl <= 0:
-            min_ttl = 60  # Default to 60 seconds if no valid TTL
-        
-        expire_time = time.time() + min_ttl
-        
-        # Store in cache
-        key = (str(qname), qtype)
-        self.cache[key] = (response, expire_time)
-        
-        # Schedule cache cleanup
-        threading.Timer(min_ttl, self.purge_expired_cache_entries).start()
-    
-    def cache_lookup(self, qname, qtype):
-        """Look up a response in the cache, respecting TTL"""
-        key = (str(qname), qtype)
-        if key in self.cache:
-            response, expire_time = self.cache[key]
-            
-            if time.time() < expire_time:
-                # Cache hit is still valid
-                return response
-            else:
-                # Expired, remove from cache
-                del self.cache[key]
-        
-        # Check for a CNAME entry in the cache
-        key = (str(qname), QTYPE.CNAME)
-        if key in self.cache:
-            cname_response, expire_time = self.cache[key]
-            
-            if time.time() < expire_time:
-                # Follow the CNAME chain
-                for rr in cname_response.rr:
-                    if rr.rtype == QTYPE.CNAME:
-                        cname_target = str(rr.rdata.label).rstrip(".")
-                        
-                        # Look for the target record in cache
-                        target_key = (cname_target, qtype)
-                        if target_key in self.cache:
-                            target_response, target_expire = self.cache[target_key]
-                            
-                            if time.time() < target_expire:
-                                # Combine the responses
-                                combined = cname_response.copy()
-                                for target_rr in target_response.rr:
-                                    combined.add_answer(target_rr)
-                                return combined
-        
-        return None
-    
-    def purge_expired_cache_entries(self):
-        """Remove expired entries from the cache"""
-        now = time.time()
-        with self.cache_lock:
-            expired_keys = [k for k, (_, expire_time) in self.cache.items() if now >= expire_time]
-            for k in expired_keys:
-                del self.cache[k]
-    
     def parse_zone_file(self, path):
         """Parse the zone file to get the Authoritative domain"""
         with open(path, 'r') as f:
@@ -415,11 +1027,11 @@ class Server:
         zone_records = list(RR.fromZone(zone_text))
         for rr in zone_records:
             # Store the record in our record map
-            self.record_map[str(rr.rname).rstrip('.')].append(rr)
+            self.record_map[str(rr.rname).rstrip('.').lower()].append(rr)  # names compare case-insensitively
             
             # Find the SOA record to determine our authoritative domain
             if rr.rtype == QTYPE.SOA and not soa_domain:
-                soa_domain = str(rr.rname).rstrip('.')
+                soa_domain = str(rr.rname).rstrip('.').lower()
                 self.log(f"SOA: Authoritative for domain: {soa_domain}")
             
             # Keep track of NS records for our domain
@@ -435,13 +1047,47 @@ class Server:
             socks = select.select([self.socket], [], [], 0.1)[0]
             for conn in socks:
                 self.recv(conn)
+            
+            if self.parent_pid and os.getppid() != self.parent_pid:
+                sys.exit(0)
+
+    @staticmethod
+    def fork_workers(workers, port):
+        """Fork workers - 1 more processes serving the same port with SO_REUSEPORT
+
+        Returns (socket, shared cache, parent pid) for this process; parent pid is None
+        in the original process. Must run before any threads are started.
+        """
+        sock = Server.bind_socket(port, reuse_port=True)
+        port = sock.getsockname()[1]
+        shared_cache = SharedCache()
+        parent_pid = os.getpid()
+
+        for _ in range(workers - 1):
+            if os.fork() == 0:
+                # Each worker gets its own socket so the kernel spreads clients across them
+                sock.close()
+                return Server.bind_socket(port, reuse_port=True), shared_cache, parent_pid
+        return sock, shared_cache, None
                 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='DNS Server')
     parser.add_argument('root_ip', type=str, help="The IP address of the root server")
     parser.add_argument('zone', type=str, help="The zone file for this server")
     parser.add_argument('--port', type=int, help="The port this server should bind to", default=0)
+    parser.add_argument('--cache-entries', type=int, help="Most RRsets kept in the cache", default=10000)
+    parser.add_argument('--cache-bytes', type=int, help="Approximate memory bound of the cache", default=4 * 1024 * 1024)
+    parser.add_argument('--upstream-port', type=int, help="The port upstream DNS servers listen on", default=60053)
+    parser.add_argument('--upstream-sockets', type=int, help="Size of the shared upstream socket pool", default=4)
+    parser.add_argument('--race', action='store_true', help="Race the two fastest nameservers on the first try")
+    parser.add_argument('--no-precompile', action='store_true', help="Build every authoritative answer with dnslib (for benchmarking)")
+    parser.add_argument('--workers', type=int, help="Processes serving the port with SO_REUSEPORT", default=1)
     
     args = parser.parse_args()
-    server = Server(args.root_ip, args.zone, args.port)
+    sock, shared_cache, parent_pid = None, None, None
+    if args.workers > 1:
+        sock, shared_cache, parent_pid = Server.fork_workers(args.workers, args.port)
+    server = Server(args.root_ip, args.zone, args.port, args.cache_entries, args.cache_bytes,
+                    args.upstream_port, args.upstream_sockets, args.race, not args.no_precompile,
+                    sock, shared_cache, parent_pid)
     server.run()